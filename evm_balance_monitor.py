@@ -4,15 +4,22 @@ EVM Balance Monitor with Prometheus Metrics
 Monitors native token balances across EVM-compatible chains
 """
 
+import asyncio
 import json
 import time
 import logging
 import os
+import random
+import signal
 from typing import Dict, List, Optional
-from dataclasses import dataclass
-import requests
-from prometheus_client import start_http_server, Gauge, Counter
-import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
+from prometheus_client import start_http_server, Counter, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
 
 # Configure logging
 logging.basicConfig(
@@ -21,44 +28,75 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@dataclass
+# HTTP statuses worth retrying: rate limits and transient server errors
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+
+@dataclass(slots=True)
 class ChainConfig:
     """Configuration for a blockchain network"""
     name: str
     rpc_url: str
     native_token_symbol: str
     decimals: int = 18
+    rate_limit_rps: float = 10
+    cache_ttl: Optional[float] = None  # Overrides the global CACHE_TTL when set
+    wei_divisor: float = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # Cache the divisor so the hot path skips the bignum exponentiation;
+        # stored as float since Prometheus samples are float64 anyway
+        self.wei_divisor = float(10 ** self.decimals)
 
-@dataclass
+@dataclass(slots=True)
 class AddressConfig:
     """Configuration for an address to monitor"""
     address: str
     label: str
     chains: List[str]  # List of chain names to monitor this address on
 
-class EVMBalanceMonitor:
-    """Monitor for EVM-compatible chain balances"""
-    
-    def __init__(self, chains: List[ChainConfig], addresses: List[AddressConfig]):
+class EVMBalanceMonitor(Collector):
+    """Monitor for EVM-compatible chain balances
+
+    Also acts as a Prometheus collector: balance samples are kept in a plain
+    dict that the fetch path writes and collect() reads at scrape time, so
+    updating an address is a single dict write instead of three locked
+    Gauge.set() calls.
+    """
+
+    def __init__(self, chains: List[ChainConfig], addresses: List[AddressConfig],
+                 batch_size: int = 100, cache_ttl: float = 30):
         self.chains = {chain.name: chain for chain in chains}  # Convert to dict for efficient lookup
         self.addresses = addresses
-        
+        self.batch_size = batch_size
+        self.cache_ttl = cache_ttl
+
+        # Last fetched (timestamp, wei) per (chain, address); balances fresher
+        # than the TTL are served from here instead of hitting the RPC
+        self._cache: Dict[tuple, tuple] = {}
+
         # Validate that all referenced chains exist
         self._validate_address_chains()
-        
+
+        # Chains and addresses are immutable after construction, so invert
+        # the address -> chains mapping once instead of every cycle
+        chain_to_addresses = defaultdict(list)
+        for address_config in self.addresses:
+            for chain_name in address_config.chains:
+                chain_to_addresses[chain_name].append(address_config)
+        self._chain_to_addresses = dict(chain_to_addresses)
+
+        # Per-chain token buckets so fast RPCs aren't throttled by slow ones
+        self._limiters = {
+            chain.name: AsyncLimiter(chain.rate_limit_rps, 1)
+            for chain in chains
+        }
+
+        # Balance samples served by collect(), keyed by (chain, address);
+        # values are (label, token_symbol, wei, decimal, timestamp)
+        self._state: Dict[tuple, tuple] = {}
+        REGISTRY.register(self)
+
         # Prometheus metrics
-        self.balance_gauge = Gauge(
-            'evm_balance_wei',
-            'Native token balance in wei',
-            ['chain', 'address', 'label', 'token_symbol']
-        )
-        
-        self.balance_decimal_gauge = Gauge(
-            'evm_balance_decimal',
-            'Native token balance in decimal form',
-            ['chain', 'address', 'label', 'token_symbol']
-        )
-        
         self.request_counter = Counter(
             'evm_balance_requests_total',
             'Total number of balance requests',
@@ -71,18 +109,51 @@ class EVMBalanceMonitor:
             ['chain', 'error_type']
         )
         
-        self.last_update_timestamp = Gauge(
+        self.headers = {
+            'User-Agent': 'EVMBalanceMonitor/1.0'
+        }
+
+        # The label sets are static, so resolve the counter children once
+        # instead of paying the labels() lookup + lock on every cycle
+        self._request_children = {
+            (chain.name, status): self.request_counter.labels(chain=chain.name, status=status)
+            for chain in chains
+            for status in ('success', 'failed')
+        }
+
+        self._error_children = {
+            (chain.name, error_type): self.error_counter.labels(chain=chain.name, error_type=error_type)
+            for chain in chains
+            for error_type in ('rpc_error', 'no_result', 'request_failed', 'json_decode', 'unexpected')
+        }
+    
+    def collect(self):
+        """Yield balance metric families from the current state (scrape path)"""
+        balance_wei = GaugeMetricFamily(
+            'evm_balance_wei',
+            'Native token balance in wei',
+            labels=['chain', 'address', 'label', 'token_symbol']
+        )
+        balance_decimal = GaugeMetricFamily(
+            'evm_balance_decimal',
+            'Native token balance in decimal form',
+            labels=['chain', 'address', 'label', 'token_symbol']
+        )
+        last_update = GaugeMetricFamily(
             'evm_balance_last_update_timestamp',
             'Timestamp of last successful balance update',
-            ['chain', 'address', 'label']
+            labels=['chain', 'address', 'label']
         )
-        
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Content-Type': 'application/json',
-            'User-Agent': 'EVMBalanceMonitor/1.0'
-        })
-    
+
+        for (chain_name, address), (label, symbol, wei, decimal, timestamp) in self._state.items():
+            balance_wei.add_metric([chain_name, address, label, symbol], wei)
+            balance_decimal.add_metric([chain_name, address, label, symbol], decimal)
+            last_update.add_metric([chain_name, address, label], timestamp)
+
+        yield balance_wei
+        yield balance_decimal
+        yield last_update
+
     def _validate_address_chains(self):
         """Validate that all chain references in addresses exist"""
         for address_config in self.addresses:
@@ -93,146 +164,225 @@ class EVMBalanceMonitor:
                         f"Available chains: {list(self.chains.keys())}"
                     )
         
-    def hex_to_decimal(self, hex_value: str) -> int:
-        """Convert hex string to decimal integer"""
-        try:
-            # Remove '0x' prefix if present
-            if hex_value.startswith('0x'):
-                hex_value = hex_value[2:]
-            return int(hex_value, 16)
-        except ValueError as e:
-            logger.error(f"Failed to convert hex to decimal: {hex_value}, error: {e}")
-            return 0
-    
-    def wei_to_decimal(self, wei_amount: int, decimals: int = 18) -> float:
-        """Convert wei amount to decimal token amount"""
-        return wei_amount / (10 ** decimals)
-    
-    def get_balance(self, chain: ChainConfig, address: str) -> Optional[int]:
-        """Get balance for an address on a specific chain"""
-        payload = {
-            "jsonrpc": "2.0",
-            "method": "eth_getBalance",
-            "params": [address, "latest"],
-            "id": 1
-        }
-        
-        try:
-            response = self.session.post(
-                chain.rpc_url,
-                json=payload,
-                timeout=30
+    async def _post_with_retries(self, client: httpx.AsyncClient, chain: ChainConfig,
+                                 body: bytes, retries: int = 3) -> httpx.Response:
+        """POST a batch payload, retrying transient failures with backoff + jitter"""
+        for attempt in range(retries + 1):
+            try:
+                async with self._limiters[chain.name]:
+                    response = await client.post(
+                        chain.rpc_url,
+                        content=body,
+                        headers={'Content-Type': 'application/json'},
+                        timeout=30.0
+                    )
+            except httpx.TransportError:
+                if attempt == retries:
+                    raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS or attempt == retries:
+                    return response
+
+            # Exponential backoff with jitter so retries don't synchronize
+            delay = min(2.0, 0.25 * (2 ** attempt)) + random.uniform(0, 0.25)
+            logger.warning(
+                "Retrying request for %s in %.2fs (attempt %d/%d)",
+                chain.name, delay, attempt + 1, retries
             )
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            if 'error' in data:
-                error_msg = data['error'].get('message', 'Unknown RPC error')
-                logger.error(f"RPC error for {chain.name} - {address}: {error_msg}")
-                self.error_counter.labels(chain=chain.name, error_type='rpc_error').inc()
-                return None
-            
-            if 'result' not in data:
-                logger.error(f"No result in response for {chain.name} - {address}")
-                self.error_counter.labels(chain=chain.name, error_type='no_result').inc()
-                return None
-            
-            hex_balance = data['result']
-            balance_wei = self.hex_to_decimal(hex_balance)
-            
-            self.request_counter.labels(chain=chain.name, status='success').inc()
-            return balance_wei
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Request failed for {chain.name} - {address}: {e}")
-            self.error_counter.labels(chain=chain.name, error_type='request_failed').inc()
-            self.request_counter.labels(chain=chain.name, status='failed').inc()
-            return None
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decode error for {chain.name} - {address}: {e}")
-            self.error_counter.labels(chain=chain.name, error_type='json_decode').inc()
-            self.request_counter.labels(chain=chain.name, status='failed').inc()
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error for {chain.name} - {address}: {e}")
-            self.error_counter.labels(chain=chain.name, error_type='unexpected').inc()
-            self.request_counter.labels(chain=chain.name, status='failed').inc()
-            return None
-    
-    def update_metrics(self):
-        """Update all balance metrics"""
-        logger.info("Starting balance update cycle")
-        
-        # Create a mapping of chain -> addresses to minimize requests
-        chain_address_map = {}
-        for address_config in self.addresses:
-            for chain_name in address_config.chains:
-                if chain_name not in chain_address_map:
-                    chain_address_map[chain_name] = []
-                chain_address_map[chain_name].append(address_config)
-        
-        # Process each chain only once with its relevant addresses
-        for chain_name, address_configs in chain_address_map.items():
-            chain = self.chains[chain_name]
-            logger.info(f"Updating balances for chain: {chain_name} ({len(address_configs)} addresses)")
-            
-            for address_config in address_configs:
-                address = address_config.address
-                label = address_config.label
-                
-                balance_wei = self.get_balance(chain, address)
-                
+            await asyncio.sleep(delay)
+
+    async def get_balances_batch(self, client: httpx.AsyncClient, chain: ChainConfig,
+                                 addresses: List[str]) -> Dict[str, Optional[int]]:
+        """Get balances for multiple addresses on a chain using JSON-RPC batch requests"""
+        balances: Dict[str, Optional[int]] = {address: None for address in addresses}
+
+        # Chunk the address list to stay within provider batch limits
+        for start in range(0, len(addresses), self.batch_size):
+            chunk = addresses[start:start + self.batch_size]
+            payload = [
+                {
+                    "jsonrpc": "2.0",
+                    "method": "eth_getBalance",
+                    "params": [address, "latest"],
+                    "id": i
+                }
+                for i, address in enumerate(chunk)
+            ]
+
+            # orjson is considerably faster than stdlib json for large batches;
+            # pass pre-encoded bytes so the client doesn't re-serialize
+            body = orjson.dumps(payload)
+
+            try:
+                response = await self._post_with_retries(client, chain, body)
+                response.raise_for_status()
+                results = orjson.loads(response.content)
+
+                if not isinstance(results, list):
+                    logger.error("Expected batch response list for %s, got: %s", chain.name, type(results).__name__)
+                    self._error_children[(chain.name, 'no_result')].inc()
+                    self._request_children[(chain.name, 'failed')].inc()
+                    continue
+
+                # Match results back to addresses by request id
+                for result in results:
+                    request_id = result.get('id')
+                    if not isinstance(request_id, int) or not 0 <= request_id < len(chunk):
+                        logger.error("Batch response with unknown id for %s: %s", chain.name, request_id)
+                        self._error_children[(chain.name, 'no_result')].inc()
+                        continue
+
+                    address = chunk[request_id]
+
+                    if 'error' in result:
+                        error_msg = result['error'].get('message', 'Unknown RPC error')
+                        logger.error("RPC error for %s - %s: %s", chain.name, address, error_msg)
+                        self._error_children[(chain.name, 'rpc_error')].inc()
+                        continue
+
+                    if 'result' not in result:
+                        logger.error("No result in response for %s - %s", chain.name, address)
+                        self._error_children[(chain.name, 'no_result')].inc()
+                        continue
+
+                    hex_balance = result['result']
+                    try:
+                        # Short-circuit the very common zero-balance response
+                        balances[address] = 0 if hex_balance in ('0x0', '0x') else int(hex_balance, 16)
+                    except (TypeError, ValueError) as e:
+                        logger.error("Failed to convert hex to decimal: %s, error: %s", hex_balance, e)
+                        balances[address] = 0
+
+                self._request_children[(chain.name, 'success')].inc()
+
+            except httpx.HTTPError as e:
+                logger.error("Batch request failed for %s: %s", chain.name, e)
+                self._error_children[(chain.name, 'request_failed')].inc()
+                self._request_children[(chain.name, 'failed')].inc()
+            except orjson.JSONDecodeError as e:
+                logger.error("JSON decode error for %s: %s", chain.name, e)
+                self._error_children[(chain.name, 'json_decode')].inc()
+                self._request_children[(chain.name, 'failed')].inc()
+            except Exception as e:
+                logger.error("Unexpected error for %s: %s", chain.name, e)
+                self._error_children[(chain.name, 'unexpected')].inc()
+                self._request_children[(chain.name, 'failed')].inc()
+
+        return balances
+
+    async def _update_chain(self, client: httpx.AsyncClient, chain: ChainConfig,
+                            address_configs: List[AddressConfig]):
+        """Fetch and update metrics for all addresses on a single chain"""
+        ttl = chain.cache_ttl if chain.cache_ttl is not None else self.cache_ttl
+        now = time.time()
+
+        # Serve addresses with a fresh cached balance without an RPC call
+        balances: Dict[str, Optional[int]] = {}
+        to_fetch = []
+        for address_config in address_configs:
+            cached = self._cache.get((chain.name, address_config.address))
+            if cached is not None and now - cached[0] < ttl:
+                balances[address_config.address] = cached[1]
+            else:
+                to_fetch.append(address_config.address)
+
+        logger.info(
+            "Updating balances for chain: %s (%d fetched, %d cached)",
+            chain.name, len(to_fetch), len(address_configs) - len(to_fetch)
+        )
+
+        if to_fetch:
+            fetched = await self.get_balances_batch(client, chain, to_fetch)
+            for address, balance_wei in fetched.items():
                 if balance_wei is not None:
-                    balance_decimal = self.wei_to_decimal(balance_wei, chain.decimals)
-                    
-                    # Update Prometheus metrics
-                    self.balance_gauge.labels(
-                        chain=chain_name,
-                        address=address,
-                        label=label,
-                        token_symbol=chain.native_token_symbol
-                    ).set(balance_wei)
-                    
-                    self.balance_decimal_gauge.labels(
-                        chain=chain_name,
-                        address=address,
-                        label=label,
-                        token_symbol=chain.native_token_symbol
-                    ).set(balance_decimal)
-                    
-                    self.last_update_timestamp.labels(
-                        chain=chain_name,
-                        address=address,
-                        label=label
-                    ).set(time.time())
-                    
-                    logger.info(
-                        f"Updated balance for {label} ({address}) on {chain_name}: "
-                        f"{balance_decimal:.6f} {chain.native_token_symbol}"
-                    )
-                else:
-                    logger.warning(f"Failed to get balance for {label} ({address}) on {chain_name}")
-                
-                # Small delay between requests to avoid rate limiting
-                time.sleep(0.1)
-        
+                    self._cache[(chain.name, address)] = (now, balance_wei)
+            balances.update(fetched)
+
+        for address_config in address_configs:
+            address = address_config.address
+            label = address_config.label
+
+            balance_wei = balances.get(address)
+
+            if balance_wei is not None:
+                balance_decimal = balance_wei / chain.wei_divisor
+
+                # A single dict write; collect() turns this into samples at scrape time
+                self._state[(chain.name, address)] = (
+                    label, chain.native_token_symbol, balance_wei, balance_decimal, time.time()
+                )
+
+                logger.info(
+                    "Updated balance for %s (%s) on %s: %.6f %s",
+                    label, address, chain.name, balance_decimal, chain.native_token_symbol
+                )
+            else:
+                logger.warning("Failed to get balance for %s (%s) on %s", label, address, chain.name)
+
+    async def update_metrics(self, client: httpx.AsyncClient):
+        """Update all balance metrics, fetching every chain concurrently"""
+        logger.info("Starting balance update cycle")
+
+        # Each chain is an independent endpoint, so fetch them all in parallel
+        tasks = [
+            self._update_chain(client, self.chains[chain_name], address_configs)
+            for chain_name, address_configs in self._chain_to_addresses.items()
+        ]
+        await asyncio.gather(*tasks)
+
         logger.info("Balance update cycle completed")
-    
+
+    async def _run_loop(self, update_interval: int):
+        """Run the monitoring loop on the event loop"""
+        # HTTP/2 multiplexes concurrent batch requests to the same RPC host
+        # over one connection; keepalive avoids a TLS handshake per cycle
+        limits = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+        # Transport-level retries cover failures to establish a connection;
+        # _post_with_retries handles 429/5xx responses and timeouts
+        transport = httpx.AsyncHTTPTransport(retries=3, http2=True, limits=limits)
+        async with httpx.AsyncClient(transport=transport, headers=self.headers) as client:
+            # Schedule cycles against fixed deadlines rather than sleeping a
+            # full interval after each one, so fetch time doesn't accumulate
+            # as drift between updates
+            deadline = time.monotonic()
+            while True:
+                try:
+                    await self.update_metrics(client)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("Error in monitoring loop: %s", e)
+
+                deadline += update_interval
+                now = time.monotonic()
+                if deadline < now:
+                    logger.warning(
+                        "Update cycle overran the %ss interval by %.1fs; skipping ahead",
+                        update_interval, now - deadline
+                    )
+                    deadline = now + update_interval
+                await asyncio.sleep(max(0, deadline - now))
+
+    async def run_forever(self, update_interval: int = 60):
+        """Run the monitoring loop until SIGTERM/SIGINT"""
+        loop = asyncio.get_running_loop()
+        task = asyncio.create_task(self._run_loop(update_interval))
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, task.cancel)
+
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info("Monitoring stopped")
+
     def start_monitoring(self, update_interval: int = 60):
         """Start the monitoring loop"""
         logger.info(f"Starting monitoring with {update_interval}s interval")
-        
-        while True:
-            try:
-                self.update_metrics()
-                time.sleep(update_interval)
-            except KeyboardInterrupt:
-                logger.info("Monitoring stopped by user")
-                break
-            except Exception as e:
-                logger.error(f"Error in monitoring loop: {e}")
-                time.sleep(10)  # Wait before retrying
+
+        try:
+            asyncio.run(self.run_forever(update_interval))
+        except KeyboardInterrupt:
+            logger.info("Monitoring stopped by user")
 
 def load_chains_from_env() -> List[ChainConfig]:
     """Load chain configurations from environment variables"""
@@ -251,7 +401,9 @@ def load_chains_from_env() -> List[ChainConfig]:
                 name=chain_data['name'],
                 rpc_url=chain_data['rpc_url'],
                 native_token_symbol=chain_data['native_token_symbol'],
-                decimals=chain_data.get('decimals', 18)
+                decimals=chain_data.get('decimals', 18),
+                rate_limit_rps=chain_data.get('rate_limit_rps', 10),
+                cache_ttl=chain_data.get('cache_ttl')
             )
             chains.append(chain)
             logger.info(f"Loaded chain config: {chain.name}")
@@ -305,6 +457,24 @@ def load_addresses_from_env() -> List[AddressConfig]:
     
     return addresses
 
+def set_cpu_affinity(server_thread):
+    """Pin the monitor and the metrics server to separate CPU cores
+
+    Opt-in via AFFINITY=1; needs at least two cores and, inside containers,
+    the SYS_NICE capability.
+    """
+    if not hasattr(os, 'sched_setaffinity'):
+        logger.warning("CPU affinity requested but not supported on this platform")
+        return
+
+    try:
+        os.sched_setaffinity(0, {0})
+        if server_thread is not None and server_thread.native_id is not None:
+            os.sched_setaffinity(server_thread.native_id, {1})
+        logger.info("Pinned monitoring loop to core 0 and metrics server to core 1")
+    except OSError as e:
+        logger.warning(f"Failed to set CPU affinity: {e}")
+
 def main():
     """Main function"""
     logger.info("Starting EVM Balance Monitor")
@@ -321,33 +491,31 @@ def main():
     # Get optional configuration from environment
     prometheus_port = int(os.getenv('PROMETHEUS_PORT', '8000'))
     update_interval = int(os.getenv('UPDATE_INTERVAL', '60'))
-    
+    batch_size = int(os.getenv('BATCH_SIZE', '100'))
+    cache_ttl = float(os.getenv('CACHE_TTL', '30'))
+
     logger.info(f"Loaded {len(chains)} chains and {len(addresses)} addresses")
     logger.info(f"Prometheus port: {prometheus_port}")
     logger.info(f"Update interval: {update_interval}s")
-    
+    logger.info(f"Batch size: {batch_size}")
+    logger.info(f"Cache TTL: {cache_ttl}s")
+
     # Initialize monitor
-    monitor = EVMBalanceMonitor(chains, addresses)
+    monitor = EVMBalanceMonitor(chains, addresses, batch_size=batch_size, cache_ttl=cache_ttl)
     
     # Start Prometheus HTTP server
-    start_http_server(prometheus_port)
+    _, server_thread = start_http_server(prometheus_port)
     logger.info(f"Prometheus metrics server started on port {prometheus_port}")
     logger.info(f"Metrics available at http://localhost:{prometheus_port}/metrics")
-    
-    # Start monitoring in a separate thread
-    monitoring_thread = threading.Thread(
-        target=monitor.start_monitoring,
-        kwargs={'update_interval': update_interval}
-    )
-    monitoring_thread.daemon = True
-    monitoring_thread.start()
-    
-    try:
-        # Keep main thread alive
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        logger.info("Shutting down...")
+
+    # Optionally pin the two threads to separate cores for cache residency
+    if os.getenv('AFFINITY') == '1':
+        set_cpu_affinity(server_thread)
+
+    # Run the monitoring loop on the main thread's event loop; the
+    # Prometheus server already runs in its own thread
+    monitor.start_monitoring(update_interval)
+    logger.info("Shutting down...")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file